@@ -0,0 +1,185 @@
+"""
+    Benchmark of the generator.
+
+    Every spec is compiled and generated with a fixed seed, so the work is the same on every run and the
+    results can be compared across commits:
+        python bench.py -o before.json
+        ... (change smg.py)
+        python bench.py --compare before.json
+
+    For every spec it reports
+        startup: seconds to construct the generator and compile the xml (best of --repeat)
+        msg/s, MB/s: throughput of messages(n, seed) (best of --repeat)
+        peak KiB: peak of memory allocated while generating, measured by tracemalloc in a separate run
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import smg
+from smg import Smg, mqtt_gen
+
+
+class BenchGen(Smg):
+    """
+        Generator of the synthetic specs.
+    """
+
+    def pick(self, args):
+        """
+            ref function: refer to the data node named <tag of ref>_<value of selector>.
+        """
+        name = f'{args[0].tag}_{self.getcontent(args[1])}'
+        self.setcontent(args[0], name)
+        return name
+
+
+def deep(depth=100):
+    """
+        set nested depth times, with a few fields at every level.
+    """
+    head = ''.join(f'<s{i} ntype="set"><a{i} ntype="bits" value="4:[0~15]"/><b{i} ntype="bytes" value="1:[0~255]"/>'
+                   for i in range(depth))
+    tail = ''.join(f'<c{i} ntype="bits" value="4:[0~15]"/></s{i}>' for i in reversed(range(depth)))
+    return f'<SMG><text>{head}{tail}</text></SMG>'
+
+def wide(n=500):
+    """
+        n flat fields of every type.
+    """
+    kinds = ['<f{i} ntype="bytes" value="[1~4]:[0~255]"/>', '<f{i} ntype="bits" value="8:[0~200]"/>',
+             '<f{i} ntype="strings" value="GET|POST|PUT"/>', '<f{i} ntype="string" value="x"/>']
+    return '<SMG><text>' + ''.join(kinds[i % 4].format(i=i) for i in range(n)) + '</text></SMG>'
+
+def payload(size=65536):
+    """
+        large byte payloads with length and checksum fields.
+    """
+    return f'''<SMG><text>
+        <len ntype="function" value="byteLength32:[p1][p2]"/>
+        <crc ntype="function" value="crc32:[p1][p2]"/>
+        <p1 ntype="bytes" value="{size}:[0~255]"/>
+        <p2 ntype="bytes" value="[0~{size}]:[0x20~0x7e]"/>
+    </text></SMG>'''
+
+def chain(n=200):
+    """
+        n functions, every function depends on the previous one.
+    """
+    fields = ['<v0 ntype="bytes" value="[1~8]:[0~255]"/>']
+    fields += [f'<v{i} ntype="function" value="varint:[v{i - 1}]"/>' for i in range(1, n)]
+    return '<SMG><text>' + ''.join(reversed(fields)) + '</text></SMG>'
+
+def refs(n=100, choices=4):
+    """
+        n references in text, every one selects one of choices sets under data.
+    """
+    text = ''.join(f'<sel{i} ntype="bits" value="8:[0~{choices - 1}]"/>'
+                   f'<r{i} ntype="function" dtype="R" value="pick:[sel{i}]"/>' for i in range(n))
+    data = ''.join(f'<r{i}_{j} ntype="set"><d{i}_{j} ntype="bytes" value="[1~{j + 1}]:[0~255]"/>'
+                   f'<e{i}_{j} ntype="string" value="ref"/></r{i}_{j}>' for i in range(n) for j in range(choices))
+    return f'<SMG><text>{text}</text><data>{data}</data></SMG>'
+
+def shipped(name):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xml-sample', name), 'r') as f:
+        return f.read()
+
+SPECS = {
+    'mqtt': (mqtt_gen, lambda: shipped('mqtttest.xml')),
+    'http': (Smg, lambda: shipped('httptest.xml')),
+    'deep': (BenchGen, deep),
+    'wide': (BenchGen, wide),
+    'payload': (BenchGen, payload),
+    'chain': (BenchGen, chain),
+    'refs': (BenchGen, refs),
+}
+
+
+def startup(cls, src):
+    for cache in (smg.parseGen, smg.parseCall, smg.parseNames, smg.parseChoices):
+        cache.cache_clear()
+    t = time.perf_counter()
+    p = cls()
+    p.fromstring(src)
+    return time.perf_counter() - t, p
+
+def throughput(p, n, seed, vectorize):
+    t = time.perf_counter()
+    size = 0
+    if vectorize:
+        for msg in p.messages(n):
+            size += len(msg)
+    else:
+        for msg in p.messages(n, seed=seed):
+            size += len(msg)
+    return time.perf_counter() - t, size
+
+def peak(p, n, seed):
+    tracemalloc.start()
+    for msg in p.messages(n, seed=seed):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def bench(name, n, repeat, seed, vectorize):
+    cls, make = SPECS[name]
+    src = make()
+    start = min(startup(cls, src)[0] for i in range(repeat))
+    p = startup(cls, src)[1]
+    elapsed, size = min(throughput(p, n, seed, vectorize) for i in range(repeat))
+    return {'spec': name, 'n': n, 'startup': start, 'msg_per_s': n / elapsed, 'bytes_per_s': size / elapsed,
+            'avg_bytes': size / n, 'peak_kib': peak(p, min(n, 1000), seed) / 1024}
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def report(results, base=None):
+    old = {r['spec']: r for r in base['results']} if base else {}
+    print(f'{"spec":<10}{"startup ms":>12}{"msg/s":>12}{"MB/s":>10}{"avg B":>10}{"peak KiB":>10}'
+          + ('   vs base' if old else ''))
+    for r in results:
+        line = (f'{r["spec"]:<10}{r["startup"] * 1e3:>12.2f}{r["msg_per_s"]:>12.0f}'
+                f'{r["bytes_per_s"] / 1e6:>10.2f}{r["avg_bytes"]:>10.0f}{r["peak_kib"]:>10.0f}')
+        if r['spec'] in old:
+            line += f'   {r["msg_per_s"] / old[r["spec"]]["msg_per_s"]:>6.2f}x'
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark of smg')
+    parser.add_argument('specs', nargs='*', default=list(SPECS), help=f'specs to run, of {", ".join(SPECS)}')
+    parser.add_argument('-n', type=int, default=2000, help='number of messages per spec')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='best of repeat runs')
+    parser.add_argument('-s', '--seed', type=int, default=1)
+    parser.add_argument('--vectorize', action='store_true', help='draw with BatchSampler instead of seed')
+    parser.add_argument('-o', '--output', default=None, help='save results as json')
+    parser.add_argument('--compare', default=None, help='json of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.specs:
+        n = max(1, args.n // 50) if name == 'payload' else args.n
+        results.append(bench(name, n, args.repeat, args.seed, args.vectorize))
+    base = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            base = json.load(f)
+    report(results, base)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'revision': revision(), 'python': platform.python_version(), 'numpy': smg.numpy is not None,
+                       'vectorize': args.vectorize, 'results': results}, f, indent=1)
+
+if __name__ == '__main__':
+    sys.setrecursionlimit(10000)
+    main()
@@ -1,18 +1,21 @@
-from smg import mqtt_gen
+from smg import mqtt_gen, Corpus
 
 def add(self, b):
     print(b[0]+b[1])
 
 
 f = open("xml-sample/mqtttest.xml",'r')
-o = open("out",'+bw')
 src = f.read()
 p = mqtt_gen()
 p.fromstring(src)
-p.gen(o)
+p.gen_corpus(1000, "out.smgc", seed=1)
 
-f = open("out",'rb')
-p.send('127.0.0.1', '1880', f)
+# replay a slice of the corpus, message #N is at hand without reading the file
+with Corpus("out.smgc") as corpus:
+    p.send('127.0.0.1', 1880, corpus[500:510])
+
+# stream messages to the broker without a temp file
+print(p.sendMany('127.0.0.1', 1880, 1000, connections=10))
 # root = etree.fromstring(src)
 # b = root.find('.//sheader')
 # print(b.getparent())
@@ -0,0 +1,421 @@
+import asyncio
+import os
+import random
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import smg
+from smg import Smg, mqtt_gen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def load(cls, src):
+    p = cls()
+    p.fromstring(src)
+    return p
+
+def mqtt():
+    with open(os.path.join(HERE, 'xml-sample', 'mqtttest.xml'), 'r') as f:
+        return load(mqtt_gen, f.read())
+
+
+def test_constant_text():
+    p = load(Smg, '<SMG><text><a ntype="string" value="AB"/><b ntype="bits" value="8:0x43"/></text></SMG>')
+    assert p.genMessage() == b'ABC'
+    assert list(p.messages(3, seed=1)) == [b'ABC'] * 3
+    assert list(p.messages(3)) == [b'ABC'] * 3
+
+def test_dedup():
+    p = load(Smg, '<SMG><text><a ntype="bits" value="8:[0~1]"/><b ntype="bits" value="8:[0~3]"/>'
+                  '<c ntype="strings" value="x|y"/></text></SMG>')
+    d = smg.Dedup()
+    assert len(list(p.iter_messages(seed=1, dedup=d, patience=500))) == 16
+    fields = d.report()['fields']
+    assert [fields[t]['coverage'] for t in 'abc'] == [1.0, 1.0, 1.0]
+
+    d = smg.Dedup(bloom=True, capacity=1000, fpr=1e-3)
+    assert len(list(p.messages(2000, dedup=d))) == 16
+
+def test_dedup_domain():
+    p = load(Smg, '<SMG><text><p ntype="bytes" value="[0~65536]:[0x20~0x7e]"/>'
+                  '<q ntype="bytes" value="[1~2]:[0~3]"/></text></SMG>')
+    d = smg.Dedup()
+    assert len(list(p.messages(1, seed=1, dedup=d))) == 1
+    assert d.domains == {'p': None, 'q': 4 + 16}
+
+    d = smg.Dedup()
+    list(mqtt().messages(20, seed=1, dedup=d))
+    assert d.report()['fields']['vheader']['coverage'] is None
+
+class Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+    def eof_received(self):
+        self.transport.close()
+
+class EchoDatagram(asyncio.DatagramProtocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(data, addr)
+
+class Abort(asyncio.Protocol):
+    def connection_made(self, transport):
+        transport.abort()
+
+def serve(protocol, frames, udp=False, connections=4):
+    async def main():
+        loop = asyncio.get_running_loop()
+        if udp:
+            server, _ = await loop.create_datagram_endpoint(protocol, local_addr=('127.0.0.1', 0))
+            port = server.get_extra_info('sockname')[1]
+        else:
+            server = await loop.create_server(protocol, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+        try:
+            sender = smg.AsyncSender('127.0.0.1', port, connections, udp, linger=0.5)
+            await asyncio.wait_for(sender.run(frames), 10)
+            return sender.total()
+        finally:
+            server.close()
+    return asyncio.run(main())
+
+def test_sender_tcp():
+    frames = list(mqtt().messages(5000, seed=1))
+    total = serve(Echo, frames)
+    assert total.frames == 5000
+    assert total.sent == total.received == sum(map(len, frames))
+
+def test_sender_udp():
+    frames = list(mqtt().messages(200, seed=1))
+    total = serve(EchoDatagram, frames, udp=True)
+    assert total.frames == 200
+    assert 0 < total.received <= total.sent == sum(map(len, frames))
+
+def test_sender_reset():
+    frames = (bytes(1024) for i in range(1 << 20))
+    start = time.monotonic()
+    with pytest.raises(ConnectionError):
+        serve(Abort, frames, connections=2)
+    assert time.monotonic() - start < 5 # not stuck on the queue of the dead connection
+
+LIB = '''<SMG><text>
+    <hdr ntype="set"><ver ntype="bits" value="4:4"/><ihl ntype="bits" value="4:[0~15]"/>
+        <tot ntype="function" value="byteLength16:[hdr][body]"/><ck ntype="function" value="checkSum:[hdr]"/></hdr>
+    <c16 ntype="function" value="crc16:[body]"/><c32 ntype="function" value="crc32le:[body]"/>
+    <ad ntype="function" value="adler32:[body]"/><vi ntype="function" value="varint:[body]"/>
+    <bl ntype="function" value="bitLength32le:[body]"/><cnt ntype="function" value="valueCount:[body][hdr]"/>
+    <body ntype="bytes" value="[0~300]:[0~255]"/>
+</text></SMG>'''
+
+def test_regen_ref_target():
+    from bench import BenchGen
+    p = load(BenchGen, REF)
+    rng = random.Random(1)
+    msg = p.generate(rng)
+    for i in range(20):
+        new = p.regen(msg, ['a'], rng)
+        if len(new.data) != len(msg.data): break
+    else:
+        assert False, 'length of a never changed'
+    assert new.data[:1] == msg.data[:1]
+    assert new.data[1] == len(new.data) - 4 # l and tail follow the new length of v
+    assert p.validate(bytes(new.data)) is None
+
+def test_cyclic_functions():
+    with pytest.raises(Exception, match='cyclic dependency of functions: a b'):
+        load(Smg, '''<SMG><text><a ntype="function" value="crc16:[b]"/><b ntype="function" value="crc16:[a]"/>
+            <c ntype="bytes" value="2:[0~255]"/></text></SMG>''')
+
+BOUNDED = '''<SMG><text>
+    <a ntype="bits" value="8:[0~9]"/><b ntype="bits" value="8:[5~7]"/><c ntype="bits" value="8:[100~200]"/>
+    <d ntype="bits" value="8:[3~4]"/><e ntype="bits" value="8:[20~30]"/>
+</text></SMG>'''
+
+def test_boundaries_coverage():
+    p = load(Smg, BOUNDED)
+    levels = [set(levels) for node, kind, levels in p.boundaries()]
+    assert levels == [{0, 1, 8, 9}, {5, 6, 7}, {100, 101, 199, 200}, {3, 4}, {20, 21, 29, 30}]
+    each = list(p.iter_boundaries('each'))
+    assert len(each) == 4
+    assert [{m[i] for m in each} for i in range(5)] == levels
+    pairwise = list(p.iter_boundaries('pairwise'))
+    for i in range(5):
+        for j in range(i + 1, 5):
+            assert {(m[i], m[j]) for m in pairwise} == {(x, y) for x in levels[i] for y in levels[j]}
+    assert len(pairwise) < len(list(p.iter_boundaries('exhaustive'))) == 4 * 3 * 4 * 2 * 4
+
+def test_field_functions():
+    assert smg.crc16(b'123456789') == 0x29b1
+    assert smg.crc32(b'123456789') == 0xcbf43926
+    assert smg.adler32(b'Wikipedia') == 0x11e60398
+    assert smg.internetChecksum(bytes.fromhex('45000073000040004011c0a80001c0a800c7')) == 0xb861
+    assert smg.varint(300) == b'\xac\x02' and smg.varint(0) == b'\0'
+    buffers = [bytes(range(n)) for n in (0, 1, 7, 100)]
+    assert smg.internetChecksumBatch(buffers) == [smg.internetChecksum(b) for b in buffers]
+    assert smg.lengthBatch([8, 16, 800], 2, 'little') == [b'\1\0', b'\2\0', b'\x64\0']
+
+    p = load(Smg, LIB)
+    msg = p.generate(random.Random(1))
+    data = msg.data
+    assert smg.internetChecksum(data[:3] + b'\0\0') == int.from_bytes(data[3:5], 'big')
+    body = p.getbytes([p.index['body']], msg.ctx)
+    assert data[-len(body) - 2:len(data) - len(body)] == b'\0\2' # valueCount of body and hdr
+
+class Crc16(Smg):
+    def crc16(self, args):
+        return self.setBytes(args[0], b'\0\0')
+
+def test_batch_functions():
+    p = load(Smg, LIB)
+    msgs = list(p.messages(2000))
+    assert p.batchable
+    assert all(p.validate(m) is None for m in msgs[:200])
+
+    q = load(Crc16, LIB) # overridden without a batch variant
+    list(q.messages(10))
+    assert not q.batchable
+    q = mqtt() # ref functions
+    list(q.messages(10))
+    assert not q.batchable
+
+class Wide(Smg):
+    pass
+
+def test_cache_key(tmp_path, monkeypatch):
+    key = Wide().cacheKey(LIB)
+    monkeypatch.setattr(Wide, 'widths', dict(Smg.widths, crc16=32))
+    assert Wide().cacheKey(LIB) != key
+    monkeypatch.setattr(Wide, 'crc64', lambda self, args: 64, raising=False)
+    assert Wide().cacheKey(LIB) != key
+
+    p = Smg()
+    p.fromstring(LIB, str(tmp_path))
+    q = Smg()
+    q.fromstring(LIB, str(tmp_path))
+    assert [n.tag for n in q.funcSeq] == [n.tag for n in p.funcSeq]
+    assert q.genIndex(1, 5) == p.genIndex(1, 5)
+
+def test_lazy_imports():
+    import subprocess
+    code = 'import sys, smg; print(sorted(m for m in ("numpy", "asyncio", "multiprocessing", "lxml") ' \
+           'if type(sys.modules.get(m)).__name__ == "module"))'
+    out = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == '[]'
+
+def test_mutate_resize():
+    rng = random.Random(1)
+    for p, field in ((mqtt(), 'ck_flags'), (load(Smg, LIB), 'ihl')):
+        msg = p.generate(rng)
+        for i in range(50):
+            variant = p.mutate(msg, field, 'resize', rng)
+            assert (len(variant.data) - len(msg.data)) * 8 == variant.ctx.length[p.index[field].slot] - \
+                   msg.ctx.length[p.index[field].slot]
+
+def test_profile_sampling():
+    p = mqtt()
+    prof = p.enableProfile(every=10)
+    msgs = list(p.messages(100, seed=1))
+    assert 'genSet' not in p.__dict__ # unwrapped between samples
+    assert (prof.messages, prof.sampled) == (100, 10)
+    assert prof.stats[('parse', 'rlength')][0] == 10
+    assert p.disableProfile() is prof
+    assert list(p.messages(100, seed=1)) == msgs
+
+    prof = p.enableProfile()
+    list(p.messages(20, seed=1))
+    assert prof.stats[('parse', 'rlength')][0] == 20
+    p.disableProfile()
+    assert 'genSet' not in p.__dict__
+
+def test_profile_sampling_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    p = mqtt()
+    serial = [p.genIndex(1, i) for i in range(400)]
+    prof = p.enableProfile(every=3)
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(lambda i: p.genIndex(1, i), range(400))) == serial
+    assert (prof.messages, prof.sampled, prof.active) == (400, 133, 0)
+    assert 'genSet' not in p.__dict__
+    p.disableProfile()
+
+def test_boundaries_skipped_levels(caplog):
+    # lengths 5 and 11 of n leave the message unaligned, the other levels of their rows are tried again
+    from bench import BenchGen
+    p = load(BenchGen, '''<SMG><text>
+        <t ntype="bits" value="8:[1~3]"/><n ntype="bits" value="[4~12]:[0~1]"/><pad ntype="bits" value="4:0"/>
+        <v ntype="function" dtype="R" value="pick:[t]"/>
+    </text><data>
+        <v_1 ntype="string" value="a"/><v_2 ntype="string" value="bb"/><v_3 ntype="string" value="ccc"/>
+    </data></SMG>''')
+    for mode in ('each', 'pairwise'):
+        caplog.clear()
+        msgs = list(p.iter_boundaries(mode))
+        assert {m[0] for m in msgs} == {1, 2, 3}
+        assert {len(m) - m[0] for m in msgs} == {2, 3} # n of 4 and 12 bits
+        assert 'n length 5, n length 11' in caplog.text
+
+def specs():
+    import bench
+    for name, (cls, make) in bench.SPECS.items():
+        yield name, load(cls, bench.payload(300) if name == 'payload' else make())
+    yield 'lib', load(Smg, LIB)
+
+def test_threads():
+    from concurrent.futures import ThreadPoolExecutor
+    for name, p in specs():
+        serial = [p.genIndex(5, i) for i in range(50)]
+        with ThreadPoolExecutor(8) as pool:
+            assert list(pool.map(lambda i: p.genIndex(5, i), range(50))) == serial, name
+        prof = p.enableProfile()
+        with ThreadPoolExecutor(8) as pool:
+            assert list(pool.map(lambda i: p.genIndex(5, i), range(50))) == serial, name
+        assert prof.messages == 50
+        p.disableProfile()
+
+def test_decode_roundtrip():
+    sys.setrecursionlimit(10000)
+    for name, p in specs():
+        for msg in p.messages(30, seed=2):
+            decoded = p.decode(msg)
+            assert decoded.data == msg, name
+            assert p.assemble(decoded.ctx) == msg, name
+
+def test_validate_corrupt():
+    p = load(Smg, LIB)
+    msg = bytearray(p.genIndex(1, 0))
+    msg[-1] ^= 1
+    assert p.validate(bytes(msg)) is not None
+    assert p.validate(bytes(msg[:-1])) is not None
+    assert p.validate(bytes(msg) + b'x') is not None
+
+# a ref to a target of variable length, between a length and a checksum of it
+REF = '''<SMG><text>
+    <t ntype="bits" value="8:[1~1]"/><l ntype="function" value="byteLength8:[v]"/>
+    <v ntype="function" dtype="R" value="pick:[t]"/><tail ntype="function" value="crc16:[v]"/>
+</text><data>
+    <v_1 ntype="set"><a ntype="bytes" value="[1~5]:[0~255]"/><c ntype="function" value="varint:[a]"/></v_1>
+</data></SMG>'''
+
+def test_validate_ref_backtrack():
+    # the crc after the ref makes the decoder backtrack into the variable-length target of the ref
+    from bench import BenchGen
+    p = load(BenchGen, REF)
+    rng = random.Random(2)
+    for i in range(300):
+        assert p.validate(p.genMessage(rng=rng)) is None
+
+class Buggy(Smg):
+    def crc16(self, args):
+        return self.setBytes(args[0], None.hex())
+
+def test_validate_bug():
+    p = load(Smg, LIB)
+    q = load(Buggy, LIB)
+    with pytest.raises(AttributeError):
+        q.validate(p.genIndex(1, 0))
+
+def test_validate_exit_status(tmp_path):
+    import subprocess
+    cmd = [sys.executable, os.path.join(HERE, 'smg.py'), os.path.join(HERE, 'xml-sample', 'mqtttest.xml'),
+           '-g', 'mqtt_gen', '-s', '1', '-n', '20', '-o', str(tmp_path / 'out')]
+    subprocess.run(cmd, check=True, capture_output=True)
+    ok = subprocess.run(cmd[:5] + ['--validate', str(tmp_path / 'out')], capture_output=True)
+    assert ok.returncode == 0
+    with open(tmp_path / 'out', 'r+b') as f:
+        f.seek(4)
+        f.write(b'\xff')
+    bad = subprocess.run(cmd[:5] + ['--validate', str(tmp_path / 'out')], capture_output=True)
+    assert bad.returncode == 1
+
+def test_corpus_roundtrip(tmp_path):
+    p = mqtt()
+    path = str(tmp_path / 'c.smgc')
+    assert p.gen_corpus(300, path, seed=7, layout=True) == 300
+    msgs = list(p.messages(300, seed=7))
+    assert smg.isCorpus(path)
+    with open(path, 'rb') as f:
+        header = smg.CORPUS_HEADER.unpack(f.read(smg.CORPUS_HEADER.size))
+    assert header[:2] == (smg.CORPUS_MAGIC, smg.CORPUS_VERSION)
+    assert header[2] == smg.CORPUS_SEEDS | smg.CORPUS_LAYOUT
+    assert all(offset % 8 == 0 for offset in (header[6], *header[8:12])) # blob and sections are aligned
+
+    with smg.Corpus(path) as c:
+        assert len(c) == 300
+        assert [bytes(m) for m in c] == msgs
+        assert bytes(c[-1]) == msgs[-1]
+        assert [bytes(m) for m in c[10:50:7]] == msgs[10:50:7]
+        assert bytes(c.span(5, 9)) == b''.join(msgs[5:9])
+        assert bytes(c.span(9, 5)) == b''
+        with pytest.raises(IndexError):
+            c[300]
+        seed, index = c.seed(42)
+        assert p.genIndex(seed, index) == msgs[42]
+        assert c.layout(42) == {tag: span for tag, span in p.layout(p.decode(msgs[42]).ctx).items()
+                                if tag in c.tags}
+        assert c.meta['generator'] == 'smg.mqtt_gen'
+        view = c[0]
+    assert bytes(view) == msgs[0] # the mapping stays while a message is in use
+
+def test_corpus_writer(tmp_path):
+    path = str(tmp_path / 'w.smgc')
+    msgs = [bytes([i]) * i for i in range(100)]
+    with smg.CorpusWriter(path, chunk=7) as w:
+        for msg in msgs:
+            w.add(msg)
+    with smg.Corpus(path) as c:
+        assert [bytes(m) for m in c] == msgs
+        assert c.seeds is None and c.spans is None
+        with pytest.raises(Exception):
+            c.seed(0)
+
+    p = load(Smg, LIB)
+    path = str(tmp_path / 'd.smgc')
+    n = p.gen_corpus(500, path, seed=1, start=100, dedup=smg.Dedup())
+    with smg.Corpus(path) as c:
+        assert len(c) == n
+        assert all(p.genIndex(*c.seed(i)) == bytes(c[i]) for i in range(0, n, 50))
+
+    with open(tmp_path / 'bad', 'wb') as f:
+        f.write(bytes(200))
+    with pytest.raises(Exception, match='not a corpus'):
+        smg.Corpus(str(tmp_path / 'bad'))
+
+def test_assemble_in_place():
+    p = load(Smg, LIB)
+    msg = p.generate(random.Random(1))
+    out = p.assemble(msg.ctx)
+    assert type(out) is bytearray and out == msg.data
+    buf = bytearray(len(out) + 10)
+    assert p.assemble(msg.ctx, buf, 5) == len(out) + 5
+    assert buf[5:-5] == out and buf[:5] == buf[-5:] == bytes(5)
+
+def test_message_bytes():
+    p = load(Smg, LIB)
+    msg = p.generate(random.Random(1))
+    assert type(bytes(msg)) is bytes and bytes(msg) == msg.data
+    assert len({bytes(msg), bytes(msg)}) == 1
+
+def test_write_wrapped(tmp_path):
+    import gzip
+    p = mqtt()
+    with gzip.open(tmp_path / 'out.gz', 'wb') as f:
+        assert p.gen_many(10, f, seed=1) == 10
+    with gzip.open(tmp_path / 'out.gz', 'rb') as f:
+        assert list(smg.readRecords(f)) == list(p.messages(10, seed=1))
+
+def test_parallel_start(tmp_path):
+    p = mqtt()
+    with open(tmp_path / 'out', 'wb') as f:
+        assert p.gen_parallel(50, f, 3, workers=2, chunk=20, start=1000) == 50
+    with open(tmp_path / 'out', 'rb') as f:
+        assert list(smg.readRecords(f)) == list(p.messages(50, seed=3, start=1000))